@@ -5,74 +5,106 @@ from .wrn.models.wide_resnet_cifar import WideResNet
 from .resnet12 import Resnet12
 import torch.nn.functional as F
 
-class GAP(torch.nn.Module):
-    def __init__(self):
-        super().__init__()
-    def forward(self, x):
-        return x.mean(3).mean(2)
+def rename_legacy_keys(state_dict, prefix, renames):
+    """Renames in place the keys of checkpoints saved before the layers were grouped in containers."""
+    for key in list(state_dict.keys()):
+        if not key.startswith(prefix):
+            continue
+        name, _, rest = key[len(prefix):].partition(".")
+        if name in renames:
+            state_dict[prefix + renames[name] + "." + rest] = state_dict.pop(key)
+
 class Conv4(torch.nn.Module):
+    # (min(in_h, in_w) // 4 threshold, strides of the four blocks), first match wins
+    stride_plan = [(16, (2, 2, 2, 2)),
+                   (8, (1, 2, 2, 2)),
+                   (4, (1, 2, 2, 1)),
+                   (2, (1, 2, 1, 1)),
+                   (0, (1, 1, 1, 1))]
+    # parameter names of checkpoints saved before the blocks were grouped in self.features
+    legacy_names = {**{"conv%d" % i: "features.%d.0" % i for i in range(4)},
+                    **{"bn%d" % i: "features.%d.1" % i for i in range(4)}}
+
     def __init__(self, in_h, in_w, channels, output_size, gap=True):
         super().__init__()
-        in_size = min(in_w, in_h)
-        ratio = in_size // 4
-        if ratio >= 16:
-            self.strides = [2, 2, 2, 2]
-        elif ratio >= 8:
-            self.strides = [1, 2, 2, 2]
-        elif ratio >= 4:
-            self.strides = [1, 2, 2, 1]
-        elif ratio >= 2:
-            self.strides = [1, 2, 1, 1]
-        else:
-            self.strides = [1, 1, 1, 1]
+        ratio = min(in_w, in_h) // 4
+        self.strides = next(list(strides) for threshold, strides in self.stride_plan if ratio >= threshold)
         self.channels = [32, 64, 128, 256]
-        in_ch = channels
-        for i in range(4):
-            setattr(self, "conv%d" %i, torch.nn.Conv2d(in_ch, self.channels[i], 3, self.strides[i], 1, bias=False))
-            setattr(self, "bn%d" %i, torch.nn.BatchNorm2d(self.channels[i]))
-            in_ch = self.channels[i]
+        in_chs = [channels] + self.channels[:-1]
+        self.features = torch.nn.Sequential(*[
+            torch.nn.Sequential(torch.nn.Conv2d(in_ch, out_ch, 3, stride, 1, bias=False),
+                                torch.nn.BatchNorm2d(out_ch),
+                                torch.nn.LeakyReLU(inplace=True))
+            for in_ch, out_ch, stride in zip(in_chs, self.channels, self.strides)])
         self.gap = gap
         if gap:
             self.out = torch.nn.Linear(self.channels[-1], output_size)
         else:
             self.out = torch.nn.Linear(self.channels[-1] * 4 * 4, output_size)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        rename_legacy_keys(state_dict, prefix, self.legacy_names)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
         
     def forward(self, x):
-        for i in range(4):
-            conv = getattr(self, "conv%d" %i)
-            bn = getattr(self, "bn%d" %i)
-            x = conv(x)
-            x = F.leaky_relu(bn(x), inplace=True)
+        x = self.features(x.contiguous(memory_format=torch.channels_last))
         if self.gap:
-            return self.out(x.mean(3).mean(2))
+            return self.out(x.mean((2, 3)))
         else:
-            return self.out(x.view(x.size(0), -1))
+            return self.out(x.flatten(1))
 
 class MLP(torch.nn.Module):
     def __init__(self, ni, no, nhidden, depth):
         super().__init__()
         self.depth = depth
-        for i in range(depth):
-            if i == 0:
-                setattr(self, "linear%d" %i, torch.nn.Linear(ni, nhidden))
-            else:
-                setattr(self, "linear%d" %i, torch.nn.Linear(nhidden, nhidden))
+        self.layers = torch.nn.ModuleList([torch.nn.Linear(ni if i == 0 else nhidden, nhidden)
+                                           for i in range(depth)])
         if depth == 0:
             nhidden = ni
         self.out = torch.nn.Linear(nhidden, no)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        rename_legacy_keys(state_dict, prefix, {"linear%d" % i: "layers.%d" % i for i in range(self.depth)})
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self, x):
         x = x.view(x.size(0), -1)
-        for i in range(self.depth):
-            linear = getattr(self, "linear%d" %i)
-            x = F.leaky_relu(linear(x))
+        for layer in self.layers:
+            x = F.leaky_relu(layer(x))
         return self.out(x)
 
+def compile_backbone(backbone, **kwargs):
+    """Fuses the backbone kernels with torch.compile, or with TorchScript on older PyTorch versions."""
+    if hasattr(torch, "compile"):
+        return torch.compile(backbone, **kwargs)
+    return torch.jit.script(backbone)
+
+# imagenet weights of the torchvision models, loaded once per process
+_PRETRAINED_STATE_DICTS = {}
+
+def _torchvision_model(name, pretrained):
+    """Builds a torchvision model, reusing its imagenet weights across calls when pretrained."""
+    backbone = getattr(models, name)(pretrained=False)
+    if pretrained:
+        if name not in _PRETRAINED_STATE_DICTS:
+            # leaves the rng state as building the model with pretrained=True would
+            with torch.random.fork_rng(devices=[]):
+                _PRETRAINED_STATE_DICTS[name] = getattr(models, name)(pretrained=True, progress=True).state_dict()
+        backbone.load_state_dict(_PRETRAINED_STATE_DICTS[name])
+    return backbone
+
 def get_backbone(exp_dict):
+    backbone = _build_backbone(exp_dict)
+    if not isinstance(backbone, MLP):
+        # lets cudnn pick its NHWC (tensor core) kernels
+        backbone = backbone.to(memory_format=torch.channels_last)
+    return backbone
+
+def _build_backbone(exp_dict):
     nclasses = exp_dict["num_classes"]
     backbone_name = exp_dict["backbone"]["name"].lower()
     if backbone_name == "resnet18":
-        backbone = models.resnet18(pretrained=exp_dict["backbone"]["imagenet_pretraining"], progress=True)
+        backbone = _torchvision_model("resnet18", exp_dict["backbone"]["imagenet_pretraining"])
         num_ftrs = backbone.fc.in_features
         backbone.fc = torch.nn.Linear(num_ftrs, nclasses) 
         if exp_dict["dataset"]["channels"] != 3:
@@ -80,7 +112,7 @@ def get_backbone(exp_dict):
             backbone._modules['conv1'] = torch.nn.Conv2d(exp_dict["dataset"]["channels"], 64, kernel_size=(7, 7), stride=(2, 2), padding=(3, 3), bias=False)
         return backbone
     elif backbone_name == "resnet50":
-        backbone = models.resnet50(pretrained=exp_dict["backbone"]["imagenet_pretraining"], progress=True)
+        backbone = _torchvision_model("resnet50", exp_dict["backbone"]["imagenet_pretraining"])
         num_ftrs = backbone.fc.in_features
         backbone.fc = torch.nn.Linear(num_ftrs, nclasses) 
         if exp_dict["dataset"]["channels"] != 3:
@@ -96,14 +128,15 @@ def get_backbone(exp_dict):
         backbone = Resnet12(1, exp_dict["dataset"]["channels"], nclasses)
         return backbone
     elif backbone_name == "vgg16":
-        backbone = models.vgg16_bn(pretrained=exp_dict["backbone"]["imagenet_pretraining"], progress=True)
+        backbone = _torchvision_model("vgg16_bn", exp_dict["backbone"]["imagenet_pretraining"])
         if exp_dict["dataset"]["channels"] != 3:
             assert(not(exp_dict["backbone"]["imagenet_pretraining"]))
             backbone._modules['features'][0] = torch.nn.Conv2d(exp_dict["dataset"]["channels"], 64, kernel_size=(3, 3), stride=(1, 1), padding=(1, 1))
         children = list(backbone.children())
         children = children[:-2]
         output = []
-        output.append(GAP())
+        # kept as a single entry so that the indices of the linear layers match older checkpoints
+        output.append(torch.nn.Sequential(torch.nn.AdaptiveAvgPool2d(1), torch.nn.Flatten()))
         output.append(torch.nn.Linear(512, 4096))
         output.append(torch.nn.ReLU(True))
         output.append(torch.nn.Linear(4096, 4096))
@@ -70,4 +70,4 @@ class Resnet12(torch.nn.Module):
         *args, c, h, w = x.size()
         x = x.view(-1, c, h, w)
         x = self.up_to_embedding(x, True)
-        return self.classifier(F.relu(self.bn_out(x.mean(3).mean(2)), True))
\ No newline at end of file
+        return self.classifier(F.relu(self.bn_out(x.mean((2, 3))), True))
\ No newline at end of file
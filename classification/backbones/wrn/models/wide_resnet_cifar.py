@@ -74,6 +74,6 @@ class WideResNet(torch.nn.Module):
         g2 = self.group_2(g1)
         o = F.relu(self.bn(g2))
         o = F.avg_pool2d(o, 8, 1, 0)
-        o = o.view(o.size(0), -1)
+        o = o.flatten(1)
         o = self.classifier(o)
         return o
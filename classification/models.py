@@ -6,7 +6,7 @@ import torch.nn.functional as F
 from sklearn.metrics import confusion_matrix
 from tqdm import tqdm
 import numpy as np
-from backbones import get_backbone
+from backbones import get_backbone, compile_backbone, Conv4
 import time
 from haven import haven_utils as hu
 
@@ -28,6 +28,11 @@ class Classification(torch.nn.Module):
         self.exp_dict = exp_dict
         self.backbone = get_backbone(exp_dict)
         self.backbone.cuda()
+        # the compiled module shares its parameters with self.backbone, which is kept for checkpointing
+        if isinstance(self.backbone, Conv4) and exp_dict["backbone"].get("compile", False):
+            self.compiled_backbone = compile_backbone(self.backbone, mode="reduce-overhead", fullgraph=True)
+        else:
+            self.compiled_backbone = self.backbone
         self.min_lr = exp_dict["lr"] * exp_dict["min_lr_decay"]
         self.optimizer = torch.optim.Adam(self.backbone.parameters(),
                                           lr=exp_dict['lr'],
@@ -107,7 +112,7 @@ class Classification(torch.nn.Module):
             y = y.cuda(non_blocking=True)
             x = x.cuda(non_blocking=False)
             with amp.autocast(enabled=self.exp_dict['amp'] > 0):
-                logits = self.backbone(x)
+                logits = self.compiled_backbone(x)
                 regularizer = 0
                 loss = F.cross_entropy(logits, y) + regularizer
             _batch_time.append(time.time() - t)
@@ -138,7 +143,7 @@ class Classification(torch.nn.Module):
             y = y.cuda(non_blocking=True)
             x = x.cuda(non_blocking=False)
             with amp.autocast(enabled=self.exp_dict['amp'] > 0):
-                logits = self.backbone(x)
+                logits = self.compiled_backbone(x)
                 regularizer = 0
             preds = logits.data.max(-1)[1]
             loss = F.cross_entropy(logits, y)
@@ -170,7 +175,7 @@ class Classification(torch.nn.Module):
             y = y.cuda(non_blocking=True)
             x = x.cuda(non_blocking=False)
             with amp.autocast(enabled=self.exp_dict['amp'] > 0):
-                logits = self.backbone(x)
+                logits = self.compiled_backbone(x)
                 regularizer = 0
             # if len(_logits) < 10**4:
             #     _logits.append(logits.data.cpu().numpy())
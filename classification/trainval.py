@@ -28,6 +28,8 @@ def trainval(exp_dict, savedir_base, data_root, reset=False, test_only=False):
 
     np.random.seed(exp_dict["seed"])
     torch.manual_seed(exp_dict["seed"])
+    # set for every experiment, the flag is global to the process
+    torch.backends.cuda.matmul.allow_tf32 = bool(exp_dict.get("tf32", False))
 
     if reset:
         # delete and backup experiment
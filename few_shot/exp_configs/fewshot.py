@@ -73,6 +73,8 @@ ProtoNet = {
     'model': "ProtoNet",
 }
 
+ProtoNet_amp = dict(ProtoNet, amp=1) # mixed precision
+
 
 MAML = {
     'model': "MAML",
@@ -162,4 +164,10 @@ EXP_GROUPS['fewshot_mini_MAML'] = random_search(
     [fewshot_mini_boilerplate, MAML, conv4_backbone], n_trials)
 
 EXP_GROUPS['fewshot_mini_RelationNet'] = random_search(
-    [fewshot_mini_boilerplate, RelationNet, conv4_backbone], n_trials)
\ No newline at end of file
+    [fewshot_mini_boilerplate, RelationNet, conv4_backbone], n_trials)
+
+
+# ------------------------------ MIXED PRECISION ------------------------------%
+
+EXP_GROUPS['fewshot_ProtoNet_amp'] = random_search(
+    [fewshot_boilerplate, ProtoNet_amp, conv4_backbone], n_trials, n_runs)
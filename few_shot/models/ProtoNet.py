@@ -3,15 +3,23 @@ import torch.nn.functional as F
 from sklearn.metrics import confusion_matrix
 from tqdm import tqdm
 import numpy as np
+from torch.cuda import amp
 from .modules.ProtoNet import prototype_distance
-from .backbones import get_backbone, count_parameters
+from .backbones import get_backbone, count_parameters, compile_backbone
 import os
+import collections
+
+EpisodeGraph = collections.namedtuple("EpisodeGraph", ["graph", "logits", "loss"])
 
 class ProtoNet(torch.nn.Module):
     def __init__(self, exp_dict):
         super().__init__()
         self.backbone = get_backbone(exp_dict, classify=False)
         self.backbone.cuda()
+        if exp_dict["backbone"].get("compile", False):
+            self.compiled_backbone = compile_backbone(self.backbone)
+        else:
+            self.compiled_backbone = self.backbone
 
         if exp_dict['optimizer'] == 'sgd':
             self.optimizer = torch.optim.SGD(self.backbone.parameters(),
@@ -28,13 +36,22 @@ class ProtoNet(torch.nn.Module):
                                                                     factor=0.1,
                                                                     patience=exp_dict['patience'],
                                                                     verbose=True)
+        self.amp = exp_dict.get("amp", 0) > 0
+        self.scaler = amp.GradScaler(enabled=self.amp)
+        # one CUDA graph per episode shape (ss, qs, nclasses, c, h, w)
+        self.cuda_graph = exp_dict.get("cuda_graph", False)
+        self.graphs = {}
+        self._label_cache = {}
+        self._input_buffers = {}
         count_parameters(self.backbone)
         self.best_val = 0
         
     def train_on_loader(self, loader):
-        _loss = 0
-        _accuracy = 0
+        # running sums stay on the gpu to avoid a host synchronization per episode
+        _loss = torch.zeros((), device='cuda')
+        _correct = torch.zeros((), device='cuda')
         _total = 0
+        _total_queries = 0
 
         # self.temp += 1
         self.backbone.train()
@@ -43,44 +60,44 @@ class ProtoNet(torch.nn.Module):
             ## Boilerplate
             episode = episode[0] # undo collate
             # plot_episode(episode, classes_first=False, epoch=self.temp)
-            support_set = episode["support_set"].cuda(non_blocking=False)
-            query_set = episode["query_set"].cuda(non_blocking=False)
-
-            ss, nclasses, c, h, w = support_set.size()
-            qs, nclasses, c, h, w = query_set.size()
+            ss, nclasses, c, h, w = episode["support_set"].size()
+            qs, nclasses, c, h, w = episode["query_set"].size()
+            x = self._to_buffer(episode)
 
-            absolute_labels = episode["targets"]
-            relative_labels = absolute_labels.clone()
-            
             # TODO: use episode['targets']
-            support_relative_labels = torch.arange(episode['nclasses']).view(1, -1).repeat(episode['support_size'], 1).cuda().view(-1)
-            query_relative_labels = torch.arange(episode['nclasses']).view(1, -1).repeat(episode['query_size'], 1).cuda().view(-1)
+            support_relative_labels = self._labels(episode['nclasses'], episode['support_size'])
+            query_relative_labels = self._labels(episode['nclasses'], episode['query_size'])
 
             ## Training
-            self.optimizer.zero_grad()
-            
-            support_embeddings = self.backbone(support_set.view(ss * nclasses, c, h, w)).view(ss * nclasses, -1)
-            query_embeddings = self.backbone(query_set.view(qs * nclasses, c, h, w)).view(qs*nclasses, -1)
-            
-            logits = prototype_distance(support_embeddings, query_embeddings, support_relative_labels)
-            loss = F.cross_entropy(logits, query_relative_labels.long())
-            _loss += float(loss)
+            if self.cuda_graph:
+                # the graph reads its inputs straight from the episode buffer
+                episode_graph = self.get_graph(x, support_relative_labels, query_relative_labels,
+                                               (ss, qs, nclasses, c, h, w))
+                episode_graph.graph.replay()
+                logits, loss = episode_graph.logits, episode_graph.loss
+            else:
+                self.optimizer.zero_grad(set_to_none=True)
+                with amp.autocast(enabled=self.amp):
+                    logits, loss = self.forward_episode(x, support_relative_labels, query_relative_labels, nclasses)
+                self.scaler.scale(loss).backward()
+            _loss += loss.detach()
             _total += 1
-            loss.backward()
-            self.optimizer.step()
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
 
             # Accuracy reporting 
             preds = logits.max(-1)[1]
-            _accuracy += float((preds == query_relative_labels).float().mean())
+            _correct += (preds == query_relative_labels).sum(dtype=torch.float32)
+            _total_queries += preds.numel()
         
-        return {"train_loss": float(_loss) / _total,
-                "train_accuracy": 100*float(_accuracy) / _total}
+        return {"train_loss": (_loss / _total).item(),
+                "train_accuracy": 100*(_correct / _total_queries).item()}
 
     @torch.no_grad()
     def val_on_loader(self, loader, mode='val', savedir=None):
-        _accuracy = 0
+        _correct = torch.zeros((), device='cuda')
         _total = 0
-        _loss = 0
+        _loss = torch.zeros((), device='cuda')
         _logits = []
         _targets = []
         self.backbone.eval()
@@ -88,37 +105,105 @@ class ProtoNet(torch.nn.Module):
             
             ## Boilerplate
             episode = episode[0] # undo collate
-            support_set = episode["support_set"].cuda(non_blocking=False)
-            query_set = episode["query_set"].cuda(non_blocking=False)
-
-            ss, nclasses, c, h, w = support_set.size()
-            qs, nclasses, c, h, w = query_set.size()
+            ss, nclasses, c, h, w = episode["support_set"].size()
+            qs, nclasses, c, h, w = episode["query_set"].size()
 
             if ss != episode["support_size"] or qs != episode["query_size"]:
                 raise(RuntimeError("The dataset is too small for the current support and query sizes"))
 
-            absolute_labels = episode["targets"]
-            relative_labels = absolute_labels.clone()
-            
             # TODO: use episode['targets']
-            support_relative_labels = torch.arange(episode['nclasses']).view(1, -1).repeat(episode['support_size'], 1).cuda().view(-1)
-            query_relative_labels = torch.arange(episode['nclasses']).view(1, -1).repeat(episode['query_size'], 1).cuda().view(-1)
+            support_relative_labels = self._labels(episode['nclasses'], episode['support_size'])
+            query_relative_labels = self._labels(episode['nclasses'], episode['query_size'])
 
             ## Testing
-            support_embeddings = self.backbone(support_set.view(ss * nclasses, c, h, w)).view(ss * nclasses, -1)
-            query_embeddings = self.backbone(query_set.view(qs * nclasses, c, h, w)).view(qs*nclasses, -1)
-            
-            logits = prototype_distance(support_embeddings, query_embeddings, support_relative_labels)
-            loss = F.cross_entropy(logits, query_relative_labels.long())
+            x = self._to_buffer(episode)
+            with amp.autocast(enabled=self.amp):
+                logits, loss = self.forward_episode(x, support_relative_labels, query_relative_labels, nclasses)
             preds = logits.max(-1)[1]
-            _loss += float(loss) * qs * nclasses
-            _accuracy += float((preds == query_relative_labels).float().sum())
+            _loss += loss * qs * nclasses
+            _correct += (preds == query_relative_labels).sum(dtype=torch.float32)
             _total += qs * nclasses
         
-        self.scheduler.step(_loss / _total)
+        # a single synchronization per pass, shared by the scheduler and the report
+        _loss = (_loss / _total).item()
+        _accuracy = (_correct / _total).item()
+        self.scheduler.step(_loss)
+        
+        return {"{}_loss".format(mode): _loss, 
+                "{}_accuracy".format(mode): 100*_accuracy}
+
+    def _labels(self, nclasses, size):
+        """Returns the relative labels [0, ..., nclasses - 1] repeated size times, cached on the gpu."""
+        key = (nclasses, size)
+        labels = self._label_cache.get(key)
+        if labels is None:
+            labels = torch.arange(nclasses, device='cuda').view(1, -1).expand(size, -1).reshape(-1).contiguous().long()
+            self._label_cache[key] = labels
+        return labels
+
+    def _to_buffer(self, episode):
+        """Copies the support set followed by the query set to a channels_last gpu buffer.
+
+        The buffer is reused by all episodes of the same shape, so that both sets go through the
+        backbone in a single forward without allocating a new input.
+        """
+        ss, nclasses, c, h, w = episode["support_set"].size()
+        qs = episode["query_set"].size(0)
+        key = (ss, qs, nclasses, c, h, w)
+        if key not in self._input_buffers:
+            self._input_buffers[key] = torch.empty((ss + qs) * nclasses, c, h, w,
+                                                   dtype=episode["support_set"].dtype, device='cuda',
+                                                   memory_format=torch.channels_last)
+        x = self._input_buffers[key]
+        x[:ss * nclasses].copy_(episode["support_set"].view(ss * nclasses, c, h, w), non_blocking=True)
+        x[ss * nclasses:].copy_(episode["query_set"].view(qs * nclasses, c, h, w), non_blocking=True)
+        return x
+
+    def forward_episode(self, x, support_relative_labels, query_relative_labels, nclasses):
+        embeddings = self.compiled_backbone(x).flatten(1)
+        support_embeddings, query_embeddings = embeddings.split([support_relative_labels.size(0),
+                                                                 query_relative_labels.size(0)], dim=0)
         
-        return {"{}_loss".format(mode): _loss / _total, 
-                "{}_accuracy".format(mode): 100*(_accuracy / _total)}
+        logits = prototype_distance(support_embeddings, query_embeddings, support_relative_labels, nclasses)
+        loss = F.cross_entropy(logits, query_relative_labels.long())
+        return logits, loss
+
+    def get_graph(self, x, support_relative_labels, query_relative_labels, key):
+        """Returns the CUDA graph of the forward and backward pass for episodes of shape `key`.
+
+        The graph is captured on the first episode of a given shape. The optimizer step is left out
+        of the graph so that the lr scheduler and the grad scaler keep working as in eager mode.
+        The inputs are the persistent episode buffer and cached labels, replays read them in place.
+        """
+        if key in self.graphs:
+            return self.graphs[key]
+        nclasses = key[2]
+
+        # warmup on a side stream, so that cudnn picks its algorithms before the capture
+        buffers = [b.clone() for b in self.backbone.buffers()]
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                self.optimizer.zero_grad(set_to_none=False)
+                with amp.autocast(enabled=self.amp, cache_enabled=False):
+                    _, loss = self.forward_episode(x, support_relative_labels, query_relative_labels, nclasses)
+                self.scaler.scale(loss).backward()
+        torch.cuda.current_stream().wait_stream(stream)
+        # undo the batchnorm statistics updates of the warmup
+        for b, saved in zip(self.backbone.buffers(), buffers):
+            b.copy_(saved)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            # the gradients must stay allocated, replays write into them
+            self.optimizer.zero_grad(set_to_none=False)
+            with amp.autocast(enabled=self.amp, cache_enabled=False):
+                logits, loss = self.forward_episode(x, support_relative_labels, query_relative_labels, nclasses)
+            self.scaler.scale(loss).backward()
+
+        self.graphs[key] = EpisodeGraph(graph, logits, loss)
+        return self.graphs[key]
 
 #TODO: move all this elsewhere:
 
@@ -128,25 +213,24 @@ class ProtoNet(torch.nn.Module):
         state["model"] = self.backbone.state_dict()
         state["optimizer"] = self.optimizer.state_dict()
         state["scheduler"] = self.scheduler.state_dict()
+        state["amp"] = self.scaler.state_dict()
         return state
 
     def set_state_dict(self, state_dict):
         self.backbone.load_state_dict(state_dict["model"])
         self.optimizer.load_state_dict(state_dict["optimizer"])
         self.scheduler.load_state_dict(state_dict["scheduler"])
+        if "amp" in state_dict:
+            self.scaler.load_state_dict(state_dict["amp"])
 
 def plot_episode(episode, classes_first=True, savedir='figures/', epoch=0):
     import pylab
-    sample_set = episode["support_set"].cpu()
-    query_set = episode["query_set"].cpu()
-    support_size = episode["support_size"]
-    query_size = episode["query_size"]
-    if not classes_first:
-        sample_set = sample_set.permute(1, 0, 2, 3, 4)
-        query_set = query_set.permute(1, 0, 2, 3, 4)
-    n, support_size, c, h, w = sample_set.size()
-    n, query_size, c, h, w = query_set.size()
-    sample_set = ((sample_set / 2 + 0.5) * 255).numpy().astype('uint8').transpose((0, 3, 1, 4, 2)).reshape((n *h, support_size * w, c))
-    pylab.imsave(os.path.join(savedir, 'support_set_{}.png'.format(epoch)), sample_set)
-    query_set = ((query_set / 2 + 0.5) * 255).numpy().astype('uint8').transpose((0, 3, 1, 4, 2)).reshape((n *h, query_size * w, c))
-    pylab.imsave(os.path.join(savedir, 'query_set_{}.png'.format(epoch)), query_set)
+    for name in ["support_set", "query_set"]:
+        images = episode[name]
+        if not classes_first:
+            images = images.permute(1, 0, 2, 3, 4)
+        n, size, c, h, w = images.size()
+        # convert to uint8 first, so that the copy made by the transpose is 4x smaller
+        images = (images / 2 + 0.5).clamp(0, 1).mul(255).to(torch.uint8)
+        images = images.permute(0, 3, 1, 4, 2).reshape(n * h, size * w, c).cpu().numpy()
+        pylab.imsave(os.path.join(savedir, '{}_{}.png'.format(name, epoch)), images)
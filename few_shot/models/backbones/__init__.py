@@ -44,34 +44,55 @@ class Conv4(nn.Module):
 
     def forward(self, x):
         x = self.encoder(x)
-        out = x.view(x.size(0), -1)
+        out = x.flatten(1)
         if self.classify:
             out = self.output_layer(out)
         return out
 
+def rename_legacy_keys(state_dict, prefix, renames):
+    """Renames in place the keys of checkpoints saved before the layers were grouped in containers."""
+    for key in list(state_dict.keys()):
+        if not key.startswith(prefix):
+            continue
+        name, _, rest = key[len(prefix):].partition(".")
+        if name in renames:
+            state_dict[prefix + renames[name] + "." + rest] = state_dict.pop(key)
+
 class MLP(torch.nn.Module):
     def __init__(self, ni, no, nhidden, depth, flatten=True):
         super().__init__()
         self.depth = depth
         self.flatten = flatten
-        for i in range(depth):
-            if i == 0:
-                setattr(self, "linear%d" %i, torch.nn.Linear(ni, nhidden))
-            else:
-                setattr(self, "linear%d" %i, torch.nn.Linear(nhidden, nhidden))
+        self.layers = torch.nn.ModuleList([torch.nn.Linear(ni if i == 0 else nhidden, nhidden)
+                                           for i in range(depth)])
         if depth == 0:
             nhidden = ni
         self.out = torch.nn.Linear(nhidden, no)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        rename_legacy_keys(state_dict, prefix, {"linear%d" % i: "layers.%d" % i for i in range(self.depth)})
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self, x):
         if self.flatten:
             x = x.view(x.size(0), -1)
-        for i in range(self.depth):
-            linear = getattr(self, "linear%d" %i)
-            x = F.leaky_relu(linear(x))
+        for layer in self.layers:
+            x = F.leaky_relu(layer(x))
         return self.out(x)
 
+def compile_backbone(backbone, **kwargs):
+    """Fuses the backbone kernels with torch.compile, or with TorchScript on older PyTorch versions."""
+    if hasattr(torch, "compile"):
+        return torch.compile(backbone, **kwargs)
+    return torch.jit.script(backbone)
+
 def get_backbone(exp_dict, classify=True):
+    backbone = _build_backbone(exp_dict, classify=classify)
+    if not isinstance(backbone, MLP):
+        backbone = backbone.to(memory_format=torch.channels_last)
+    return backbone
+
+def _build_backbone(exp_dict, classify=True):
 
     # Seed
     # -----------
@@ -1,13 +1,15 @@
 import torch
 import numpy as np
 
-def prototype_distance(support_set, query_set, labels, unlabeled_set=None):
+def prototype_distance(support_set, query_set, labels, nclasses=None, unlabeled_set=None):
     """Computes distance from each element of the query set to prototypes in the sample set.
     Args:
         sample_set: Tensor of shape (batch, n_classes, n_sample_per_classes, z_dim) containing the representation z of
             each images.
         query_set: Tensor of shape (batch, n_classes, n_query_per_classes, z_dim) containing the representation z of
             each images.
+        nclasses: number of classes in the episode. Inferred from the labels if None, at the cost of a
+            device synchronization.
         unlabeled_set: Tensor of shape (batch, n_classes, n_unlabeled_per_classes, z_dim) containing the representation
             z of each images.
     Returns:
@@ -16,17 +18,15 @@ def prototype_distance(support_set, query_set, labels, unlabeled_set=None):
     """
     n_queries, channels = query_set.size()
     n_support, channels = support_set.size()
-  
-    support_set = support_set.view(n_support, 1, channels)
-  
-    way = int(labels.data.max()) + 1
-    one_hot_labels = torch.zeros(n_support, way, 1, dtype=support_set.dtype, device=support_set.device)
-    one_hot_labels.scatter_(1, labels.view(n_support, 1, 1), 1)
-  
-    total_per_class = one_hot_labels.sum(0, keepdim=True)
-    prototypes = (support_set * one_hot_labels).sum(0) / total_per_class
-    prototypes = prototypes.view(1, way, channels)
-  
-    query_set = query_set.view(n_queries, 1, channels)
-    d = query_set - prototypes
-    return -torch.sum(d ** 2, 2) / np.sqrt(channels)
\ No newline at end of file
+    # fp32 prototypes and differences, also when the embeddings come out of autocast in fp16
+    support_set = support_set.float()
+    query_set = query_set.float()
+
+    way = nclasses if nclasses is not None else int(labels.data.max()) + 1
+    prototypes = support_set.new_zeros(way, channels).index_add_(0, labels, support_set)
+    total_per_class = support_set.new_zeros(way).index_add_(0, labels, support_set.new_ones(n_support))
+    prototypes = prototypes / total_per_class.clamp_min(1).view(way, 1)
+
+    # exact differences rather than torch.cdist, whose matmul expansion loses precision under TF32
+    d = query_set.view(n_queries, 1, channels) - prototypes.view(1, way, channels)
+    return -torch.sum(d ** 2, 2) / np.sqrt(channels)
@@ -13,6 +13,8 @@ import torchvision.transforms as tt
 from exp_configs import EXP_GROUPS
 from models import get_model
 import pandas as pd
+import torch
+torch.backends.cudnn.benchmark = True
 
 
 def trainval(exp_dict, savedir_base, data_root, reset=False, wandb='None', wandb_key='None'):
@@ -22,6 +24,8 @@ def trainval(exp_dict, savedir_base, data_root, reset=False, wandb='None', wandb
     # get experiment directory
     exp_id = hu.hash_dict(exp_dict)
     savedir = os.path.join(savedir_base, exp_id)
+    # set for every experiment, the flag is global to the process
+    torch.backends.cuda.matmul.allow_tf32 = bool(exp_dict.get("tf32", False))
 
     if reset:
         # delete and backup experiment
@@ -64,42 +68,49 @@ def trainval(exp_dict, savedir_base, data_root, reset=False, wandb='None', wandb
         ood = False
         
     # train and val loader
+    loader_kwargs = {"num_workers": args.num_workers, "pin_memory": True}
+    if args.num_workers > 0:
+        loader_kwargs["prefetch_factor"] = 4
     if exp_dict["episodic"] == False:
         train_loader = DataLoader(train_dataset,
                                     batch_size=exp_dict['batch_size'],
                                     shuffle=True,
-                                    num_workers=args.num_workers) 
+                                    persistent_workers=args.num_workers > 0,
+                                    **loader_kwargs)
         val_loader = DataLoader(val_dataset,
                                     batch_size=exp_dict['batch_size'],
                                     shuffle=True,
-                                    num_workers=args.num_workers) 
+                                    persistent_workers=args.num_workers > 0,
+                                    **loader_kwargs)
         test_loader = DataLoader(test_dataset,
                                     batch_size=exp_dict['batch_size'],
                                     shuffle=True,
-                                    num_workers=args.num_workers) 
+                                    persistent_workers=args.num_workers > 0,
+                                    **loader_kwargs)
     else: # to support episodes TODO: move inside each model
         from datasets.episodic_dataset import EpisodicDataLoader
+        # no persistent workers: the episodes of each epoch are resampled in the main process
         train_loader = EpisodicDataLoader(train_dataset,
                                     batch_size=exp_dict['batch_size'],
                                     shuffle=True,
                                     collate_fn=lambda x: x,
-                                    num_workers=args.num_workers) 
+                                    **loader_kwargs)
         val_loader = EpisodicDataLoader(val_dataset,
                                     batch_size=exp_dict['batch_size'],
                                     shuffle=True,
                                     collate_fn=lambda x: x,
-                                    num_workers=args.num_workers) 
+                                    **loader_kwargs)
         test_loader = EpisodicDataLoader(test_dataset,
                                     batch_size=exp_dict['batch_size'],
                                     shuffle=True,
                                     collate_fn=lambda x: x,
-                                    num_workers=args.num_workers) 
+                                    **loader_kwargs)
         if ood:
             ood_loader = EpisodicDataLoader(ood_dataset,
                                         batch_size=exp_dict['batch_size'],
                                         shuffle=True,
                                         collate_fn=lambda x: x,
-                                        num_workers=args.num_workers) 
+                                        **loader_kwargs)
                 
     
 